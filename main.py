@@ -1,21 +1,48 @@
 import re
+import functools
+import hashlib
+from collections import OrderedDict
+from types import MappingProxyType
 from datetime import datetime
-from typing import Optional
+from typing import List, NamedTuple, Optional
+from zoneinfo import ZoneInfo
 import os
+import base64
 
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware # Import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from pydantic import BaseModel
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+from google.oauth2 import service_account
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
-import pytz
-import json # Import the json module
+import orjson
 
 # Load environment variables from .env file
 load_dotenv()
 
 # --- Google Cloud Vision Client Initialization ---
+# Options for the one gRPC channel shared by every OCR call. Keepalive pings hold
+# the HTTP/2 connection open through idle periods so the next request does not
+# pay for a fresh TCP/TLS handshake. The message-size options match the
+# defaults the generated transport uses when it builds its own channel.
+_GRPC_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 60000),
+    ("grpc.keepalive_timeout_ms", 20000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+def _create_vision_client(credentials=None) -> vision.ImageAnnotatorClient:
+    """Creates the Vision client on an explicitly configured gRPC channel (ADC when no credentials are given)."""
+    channel = ImageAnnotatorGrpcTransport.create_channel(credentials=credentials, options=_GRPC_CHANNEL_OPTIONS)
+    return vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+
 vision_client = None
 try:
     # Get the base64 encoded credentials string from the environment variable
@@ -25,22 +52,19 @@ try:
     # We will use GOOGLE_APPLICATION_CREDENTIALS_BASE64 in Render.
 
     if credentials_base64:
-        # Decode the Base64 string to get the JSON content
-        import base64
-        credentials_json_bytes = base64.b64decode(credentials_base64)
-        credentials_json_string = credentials_json_bytes.decode('utf-8')
-        
-        # Load the JSON content into a dictionary
-        credentials_dict = json.loads(credentials_json_string)
+        # Decode the Base64 string and load the JSON content into a dictionary.
+        # orjson reads the decoded bytes directly, so no intermediate str is built.
+        credentials_dict = orjson.loads(base64.b64decode(credentials_base64))
         
         # Initialize the client from the dictionary (which represents the service account info)
         # This is the key change!
-        vision_client = vision.ImageAnnotatorClient.from_service_account_info(credentials_dict)
+        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
+        vision_client = _create_vision_client(credentials)
         print("Google Cloud Vision client initialized successfully from Base64 credentials.")
     else:
         # Fallback for local development if you have GOOGLE_APPLICATION_CREDENTIALS set as a path
         # Or if no credentials_base64 is found, it will try default ADC
-        vision_client = vision.ImageAnnotatorClient() 
+        vision_client = _create_vision_client()
         print("Google Cloud Vision client initialized using default credentials (GOOGLE_APPLICATION_CREDENTIALS filepath or ADC).")
 
 except Exception as e:
@@ -52,7 +76,9 @@ except Exception as e:
 app = FastAPI(
     title="Slip OCR and Parsing API",
     description="API for performing OCR on slip images and extracting key information like amount, date, and reference number.",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson encodes datetimes and the Thai raw_text in C, much faster than the stdlib json encoder
+    default_response_class=ORJSONResponse
 )
 
 # --- CORS Middleware Configuration ---
@@ -66,234 +92,541 @@ origins = [
     "http://127.0.0.1",
 ]
 
+# Only the listed origins, methods and headers are allowed, so Starlette answers
+# preflights from fixed sets, and max_age lets browsers cache them for a day.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type"],
+    max_age=86400,
 )
 
 # --- OCR Function ---
 import asyncio
+import concurrent.futures
+
+# Caps the number of Vision API calls in flight so bursts of uploads queue here
+# instead of exhausting the project's quota.
+OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "16"))
+OCR_MAX_RETRIES = int(os.getenv("OCR_MAX_RETRIES", "3"))
+OCR_RETRY_BASE_DELAY = 0.5 # Seconds; doubled after every ResourceExhausted response
+
+_OCR_SEMAPHORE = asyncio.Semaphore(OCR_MAX_CONCURRENCY)
+# Vision calls get their own threads, one per semaphore slot, so they neither wait
+# behind nor starve other blocking work on the loop's shared default executor.
+_OCR_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=OCR_MAX_CONCURRENCY, thread_name_prefix="vision")
+
+# Vision accepts at most 16 images in one synchronous batch_annotate_images call.
+OCR_BATCH_MAX_IMAGES = 16
+_TEXT_DETECTION_FEATURE = vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)
+
+# OCR text keyed by a digest of the image bytes, so re-uploads of the same slip
+# (client retries, the same slip posted twice) skip the Vision round-trip.
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "1024"))
+_ocr_cache: "OrderedDict[bytes, str]" = OrderedDict()
+# OCR calls currently running, by the same key. An identical upload that arrives
+# while the first is still being processed (a client retrying on a slow network)
+# waits for that call instead of starting a second one.
+_ocr_in_flight: "dict[bytes, asyncio.Future]" = {}
+
+async def _call_vision(method, *args, **kwargs):
+    """Runs a blocking Vision call off the event loop, backing off while the quota is exhausted."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(method, *args, **kwargs)
+    delay = OCR_RETRY_BASE_DELAY
+    for attempt in range(OCR_MAX_RETRIES + 1):
+        try:
+            async with _OCR_SEMAPHORE:
+                return await loop.run_in_executor(_OCR_POOL, call)
+        except google_exceptions.ResourceExhausted:
+            if attempt == OCR_MAX_RETRIES:
+                raise
+        # Sleep outside the semaphore so a backing-off request does not hold a slot.
+        await asyncio.sleep(delay)
+        delay *= 2
+
+async def _detect_text(image_bytes: bytes, cache_key: bytes) -> str:
+    """Runs OCR on one image and stores the resulting text in the cache."""
+    image = vision.Image(content=image_bytes)
+    try:
+        response = await _call_vision(vision_client.text_detection, image)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Google Cloud Vision API error: {e}")
+    # Per-image failures come back in response.error rather than as an exception;
+    # they must not be cached as an empty result.
+    if response.error.message:
+        raise HTTPException(status_code=500, detail=f"Google Cloud Vision API error: {response.error.message}")
+
+    texts = response.text_annotations
+    text = texts[0].description if texts else ""
+    _cache_text(cache_key, text)
+    return text
+
+def _cache_text(cache_key: bytes, text: str) -> None:
+    """Stores OCR text, evicting the least recently used entry once the cache is full."""
+    _ocr_cache[cache_key] = text
+    if len(_ocr_cache) > OCR_CACHE_SIZE:
+        _ocr_cache.popitem(last=False)
+
+def _forget_in_flight(cache_key: bytes, task: asyncio.Future) -> None:
+    """Done-callback that unregisters a finished OCR call."""
+    _ocr_in_flight.pop(cache_key, None)
+    if not task.cancelled():
+        task.exception() # Mark any error as retrieved even if every waiter went away
 
 async def perform_ocr(image_bytes: bytes) -> str:
     if vision_client is None:
         raise RuntimeError("Google Cloud Vision client is not initialized.")
-    
-    loop = asyncio.get_event_loop()
-    image = vision.Image(content=image_bytes)
+
+    cache_key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    cached_text = _ocr_cache.get(cache_key)
+    if cached_text is not None:
+        _ocr_cache.move_to_end(cache_key)
+        return cached_text
+
+    task = _ocr_in_flight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_detect_text(image_bytes, cache_key))
+        _ocr_in_flight[cache_key] = task
+        task.add_done_callback(functools.partial(_forget_in_flight, cache_key))
+    # Shielded so one client disconnecting does not cancel the call for the others.
+    return await asyncio.shield(task)
+
+async def _detect_text_batch(pending: "dict[bytes, bytes]") -> "dict[bytes, str | HTTPException]":
+    """Runs OCR on several images in one Vision request and caches the text of each.
+
+    A failed request raises; an image Vision could not process maps to its own
+    HTTPException instead, so the other images in the batch are unaffected.
+    """
+    requests = [
+        vision.AnnotateImageRequest(image=vision.Image(content=image_bytes), features=[_TEXT_DETECTION_FEATURE])
+        for image_bytes in pending.values()
+    ]
     try:
-        response = await loop.run_in_executor(None, vision_client.text_detection, image)
-        texts = response.text_annotations
-        if texts:
-            return texts[0].description
-        return ""
+        batch = await _call_vision(vision_client.batch_annotate_images, requests=requests)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Google Cloud Vision API error: {e}")
 
+    results = {}
+    for cache_key, response in zip(pending, batch.responses):
+        if response.error.message:
+            results[cache_key] = HTTPException(status_code=500, detail=f"Google Cloud Vision API error: {response.error.message}")
+            continue
+        annotations = response.text_annotations
+        results[cache_key] = annotations[0].description if annotations else ""
+        _cache_text(cache_key, results[cache_key])
+    return results
+
+def _settle_batch(futures: "dict[bytes, asyncio.Future]", task: asyncio.Task) -> None:
+    """Done-callback that hands each image's own text or error to its waiters."""
+    for cache_key, future in futures.items():
+        if future.done():
+            continue
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        elif isinstance(task.result()[cache_key], HTTPException):
+            future.set_exception(task.result()[cache_key])
+        else:
+            future.set_result(task.result()[cache_key])
+
+async def perform_ocr_batch(images: List[bytes]) -> List["str | HTTPException"]:
+    """Runs OCR on several images, sending every uncached one in a single Vision request.
+
+    An image that fails on its own is returned as its HTTPException, in place of
+    its text; only a failure of the whole request is raised.
+    """
+    if vision_client is None:
+        raise RuntimeError("Google Cloud Vision client is not initialized.")
+
+    cache_keys = [hashlib.blake2b(image_bytes, digest_size=16).digest() for image_bytes in images]
+    texts: "dict[bytes, str | HTTPException]" = {}
+    waiting: "dict[bytes, asyncio.Future]" = {}
+    # Images that are neither cached nor already being processed, deduplicated by key.
+    pending: "dict[bytes, bytes]" = {}
+    for cache_key, image_bytes in zip(cache_keys, images):
+        if cache_key in texts or cache_key in waiting or cache_key in pending:
+            continue
+        cached_text = _ocr_cache.get(cache_key)
+        if cached_text is not None:
+            _ocr_cache.move_to_end(cache_key)
+            texts[cache_key] = cached_text
+        elif cache_key in _ocr_in_flight:
+            waiting[cache_key] = _ocr_in_flight[cache_key]
+        else:
+            pending[cache_key] = image_bytes
+
+    if pending:
+        # Each image in the batch gets its own in-flight future, so a single-image
+        # upload of the same bytes waits for this call instead of starting another.
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for cache_key in pending:
+            future = loop.create_future()
+            _ocr_in_flight[cache_key] = future
+            future.add_done_callback(functools.partial(_forget_in_flight, cache_key))
+            futures[cache_key] = future
+        task = asyncio.ensure_future(_detect_text_batch(pending))
+        task.add_done_callback(functools.partial(_settle_batch, futures))
+        # Shielded so one client disconnecting does not cancel the call for the others.
+        texts.update(await asyncio.shield(task))
+
+    for cache_key, future in waiting.items():
+        try:
+            texts[cache_key] = await asyncio.shield(future)
+        except HTTPException as e:
+            texts[cache_key] = e
+    return [texts[cache_key] for cache_key in cache_keys]
+
+
+# --- Upload Validation ---
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(8 * 1024 * 1024)))
+# Total across all files of one /parse-slip-images request; they are held in
+# memory together and sent to Vision as one request.
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv("MAX_BATCH_UPLOAD_BYTES", str(16 * 1024 * 1024)))
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of the image formats the Vision API accepts (WEBP is checked separately).
+_IMAGE_SIGNATURES = (
+    b'\x89PNG\r\n\x1a\n', # PNG
+    b'\xff\xd8\xff', # JPEG
+    b'GIF87a', b'GIF89a', # GIF
+    b'BM', # BMP
+    b'II*\x00', b'MM\x00*', # TIFF
+    b'\x00\x00\x01\x00', # ICO
+)
+
+def _is_image_magic(head: bytes) -> bool:
+    """Checks the first bytes of an upload against known image file signatures."""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    return head.startswith(_IMAGE_SIGNATURES)
+
+async def _read_image_upload(file: UploadFile, max_bytes: Optional[int] = None, too_large_detail: Optional[str] = None) -> bytes:
+    """Reads an uploaded image in chunks, rejecting non-images and oversized bodies early."""
+    if max_bytes is None:
+        max_bytes = MAX_UPLOAD_BYTES
+    if too_large_detail is None:
+        too_large_detail = f"Image is too large. The maximum size is {max_bytes} bytes."
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Invalid file type. Only image files are allowed.")
+
+    buf = bytearray()
+    while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+        # Sniff the header on the first chunk so non-images are rejected without
+        # buffering them or sending them to the (paid) Vision API.
+        if not buf and not _is_image_magic(chunk):
+            raise HTTPException(status_code=400, detail="Invalid file type. Only image files are allowed.")
+        buf += chunk
+        if len(buf) > max_bytes:
+            raise HTTPException(status_code=413, detail=too_large_detail)
+    if not buf:
+        raise HTTPException(status_code=400, detail="Invalid file type. Only image files are allowed.")
+    return bytes(buf)
+
 
 # --- Parsing Functions ---
-def parse_slip_text(text: str) -> dict:
-    """Analyzes text from a slip to extract key information: amount, date/time, reference number."""
-    amount = None
-    date_time = None
-    reference_no = None
+# Patterns are compiled once at import time so each request dispatches straight
+# to the compiled objects instead of going through the `re` module cache.
+# Every stage runs on the lowercased text, so the patterns are written in
+# lowercase and compiled without re.IGNORECASE.
+_AMOUNT_KW_RES = tuple(re.compile(p) for p in (
+    r'(?:total|amount|รวม|ยอด|ชำระ|เป็นเงิน)\D*?(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)',
+    r'(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)\D*?(?:บาท|baht|thb|total|amount|รวม|ยอด|ชำระ|เป็นเงิน)'
+))
+
+_AMOUNT_FALLBACK_RES = tuple(re.compile(p) for p in (
+    r'(\d{1,3}(?:,\d{3})*(?:\.\d{2}))',
+    r'(\d+\.\d{2})',
+    r'(\d{1,3}(?:,\d{3})*)',
+    r'(\d+)'
+))
+
+_THAI_MONTH_MAP = MappingProxyType({
+    'ม.ค.': 'jan', 'ก.พ.': 'feb', 'มี.ค.': 'mar', 'เม.ย.': 'apr',
+    'พ.ค.': 'may', 'มิ.ย.': 'jun', 'ก.ค.': 'jul', 'ส.ค.': 'aug',
+    'ก.ย.': 'sep', 'ต.ค.': 'oct', 'พ.ย.': 'nov', 'ธ.ค.': 'dec',
+    'มกราคม': 'january', 'กุมภาพันธ์': 'february', 'มีนาคม': 'march', 'เมษายน': 'april',
+    'พฤษภาคม': 'may', 'มิถุนายน': 'june', 'กรกฎาคม': 'july', 'สิงหาคม': 'august',
+    'กันยายน': 'september', 'ตุลาคม': 'october', 'พฤศจิกายน': 'november', 'ธันวาคม': 'december'
+})
+
+def _trie_pattern(words) -> str:
+    """Builds a regex that matches any of `words`, factored as a prefix trie.
+
+    Words sharing a prefix share one branch, so the engine never re-tries the same
+    leading characters for every word, and longer words win over their prefixes.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {} # End-of-word marker
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        word_ends_here = '' in node
+        if len(branches) == 1 and not word_ends_here:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')' + ('?' if word_ends_here else '')
+
+    return build(trie)
+
+# All month names in one trie-shaped pattern so the text is scanned once per request.
+_THAI_MONTH_RE = re.compile(_trie_pattern(_THAI_MONTH_MAP))
+
+def _thai_month_to_english(match: re.Match) -> str:
+    """Replacement callback for _THAI_MONTH_RE.sub, defined once instead of a lambda per call."""
+    return _THAI_MONTH_MAP[match.group(0)]
+
+# Date/time shapes in order of preference. Each shape records the position of its
+# date separator within a match (None if it has none) and the format to use for
+# each separator, so a candidate is parsed with exactly one strptime call.
+_DATETIME_PATTERNS = (
+    (r'\d{2}[-/]\d{2}[-/]\d{4}\s+\d{2}:\d{2}:\d{2}', 2, {'-': "%d-%m-%Y %H:%M:%S", '/': "%d/%m/%Y %H:%M:%S"}),
+    (r'\d{2}[-/]\d{2}[-/]\d{4}\s+\d{2}:\d{2}', 2, {'-': "%d-%m-%Y %H:%M", '/': "%d/%m/%Y %H:%M"}),
+    (r'\d{2}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2}:\d{2}', 2, {'-': "%d-%m-%y %H:%M:%S", '/': "%d/%m/%y %H:%M:%S"}),
+    (r'\d{2}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2}', 2, {'-': "%d-%m-%y %H:%M", '/': "%d/%m/%y %H:%M"}),
+    (r'\d{1,2}\s+(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\s+\d{4}\s+\d{2}:\d{2}', None, {None: "%d %b %Y %H:%M"}),
+    (r'\d{1,2}\s+(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\s+\d{2}\s+\d{2}:\d{2}', None, {None: "%d %b %y %H:%M"}),
+    (r'\d{4}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2}:\d{2}', 4, {'-': "%Y-%m-%d %H:%M:%S"}),
+    (r'\d{4}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2}', 4, {'-': "%Y-%m-%d %H:%M"}),
+    (r'\d{2}[-/]\d{2}[-/]\d{4}', 2, {'-': "%d-%m-%Y", '/': "%d/%m/%Y"}),
+    (r'\d{2}[-/]\d{2}[-/]\d{2}', 2, {'-': "%d-%m-%y", '/': "%d/%m/%y"}),
+    (r'\d{2}:\d{2}:\d{2}', None, {None: "%H:%M:%S"}),
+    (r'\d{2}:\d{2}', None, {None: "%H:%M"})
+)
 
-    lower_text = text.lower()
+_DATETIME_RES = tuple(re.compile(f'({p})') for p, _, _ in _DATETIME_PATTERNS)
 
-    # Enhanced Amount Parsing
-    amount_keywords_patterns = [
-        r'(?:total|amount|รวม|ยอด|ชำระ|เป็นเงิน)\D*?(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)',
-        r'(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)\D*?(?:บาท|baht|thb|total|amount|รวม|ยอด|ชำระ|เป็นเงิน)'
-    ]
+# Whether each shape carries a four-digit year that may be Buddhist-era; every
+# format of a shape uses the same year directive, so this is fixed per shape.
+_DATETIME_HAS_YEAR4 = tuple(
+    any('%Y' in fmt for fmt in formats.values()) for _, _, formats in _DATETIME_PATTERNS
+)
 
-    for pattern in amount_keywords_patterns:
-        match = re.search(pattern, lower_text, re.IGNORECASE)
-        if match:
-            try:
-                num_str = match.group(1).replace(',', '').replace('.', '@').replace('@', '.')
-                if num_str.count('.') > 1:
-                    num_str = num_str.replace('.', '')
-                
-                amount = float(num_str)
-                if amount > 0.99:
-                    break
-                else:
-                    amount = None
-            except ValueError:
-                amount = None
-
-    if amount is None:
-        amount_patterns = [
-            r'(\d{1,3}(?:,\d{3})*(?:\.\d{2}))',
-            r'(\d+\.\d{2})',
-            r'(\d{1,3}(?:,\d{3})*)',
-            r'(\d+)'
-        ]
-        for pattern in amount_patterns:
-            match = re.search(pattern, lower_text)
-            if match:
-                try:
-                    num_str = match.group(1).replace(',', '')
-                    amount = float(num_str)
-                    if amount > 0.99:
-                        break
-                    else:
-                        amount = None
-                except ValueError:
-                    amount = None
-
-    thai_month_map = {
-        'ม.ค.': 'Jan', 'ก.พ.': 'Feb', 'มี.ค.': 'Mar', 'เม.ย.': 'Apr',
-        'พ.ค.': 'May', 'มิ.ย.': 'Jun', 'ก.ค.': 'Jul', 'ส.ค.': 'Aug',
-        'ก.ย.': 'Sep', 'ต.ค.': 'Oct', 'พ.ย.': 'Nov', 'ธ.ค.': 'Dec',
-        'มกราคม': 'January', 'กุมภาพันธ์': 'February', 'มีนาคม': 'March', 'เมษายน': 'April',
-        'พฤษภาคม': 'May', 'มิถุนายน': 'June', 'กรกฎาคม': 'July', 'สิงหาคม': 'August',
-        'กันยายน': 'September', 'ตุลาคม': 'October', 'พฤศจิกายน': 'November', 'ธันวาคม': 'December'
-    }
+# All shapes fused into one lookahead alternation. Alternation order makes each
+# match report the most preferred shape starting at that position, so a single
+# pass finds the same candidate the shape-by-shape search would. Every shape starts
+# with a digit, so the leading (?=\d) lets the engine skip straight past the words
+# between numbers instead of trying all twelve alternatives at every position.
+_DATETIME_ANY_RE = re.compile(r'(?=\d)(?=' + '|'.join(f'({p})' for p, _, _ in _DATETIME_PATTERNS) + ')')
+
+# Time-only slips are stamped with today's date in Bangkok.
+_BANGKOK_TZ = ZoneInfo('Asia/Bangkok')
+
+_YEAR4_RE = re.compile(r'\d{4}')
+
+_REF_RES = tuple(re.compile(p) for p in (
+    r'(?:ref\s*|reference\s*|เลขที่อ้างอิง\s*|ref no\.\s*|tran id:\s*|trn id:\s*|trx ref:\s*|trn\s*|txn\s*|transaction no\.\s*|หมายเลขอ้างอิง\s*|รหัสอ้างอิง\s*|รหัสรายการ\s*|หมายเลขรายการ\s*|เลขที่อ้างอิงรายการ\s*)(\S{8,40})',
+    r'(\d{10,30})',
+    r'(?:r\s*|tid\s*|tran id\s*|ref\s*)\s*(\d{6,25})',
+    r'([a-z0-9]{8,40})'
+))
+
+# Shapes a reference candidate can only have if it is really a date or a time.
+# The matched branch selects the one format used to confirm it.
+_REF_DATE_RE = re.compile(
+    r'(?P<dmy>\d{1,2}-\d{1,2}-)(?:(?P<year4>\d{4})|\d{2})'
+    r'|(?P<hms>\d{1,2}:\d{1,2}:\d{1,2})'
+    r'|\d{1,2}:\d{1,2}'
+)
 
-    processed_text_for_date = text
-    for thai_m, eng_m in thai_month_map.items():
-        processed_text_for_date = re.sub(re.escape(thai_m), eng_m, processed_text_for_date, flags=re.IGNORECASE)
-
-    datetime_patterns = [
-        r'(\d{2}[-/]\d{2}[-/]\d{4}\s+\d{2}:\d{2}:\d{2})',
-        r'(\d{2}[-/]\d{2}[-/]\d{4}\s+\d{2}:\d{2})',
-        r'(\d{2}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2}:\d{2})',
-        r'(\d{2}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2})',
-        r'(\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{4}\s+\d{2}:\d{2})',
-        r'(\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{2}\s+\d{2}:\d{2})',
-        r'(\d{4}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2}:\d{2})',
-        r'(\d{4}[-/]\d{2}[-/]\d{2}\s+\d{2}:\d{2})',
-        r'(\d{2}[-/]\d{2}[-/]\d{4})',
-        r'(\d{2}[-/]\d{2}[-/]\d{2})',
-        r'(\d{2}:\d{2}:\d{2})',
-        r'(\d{2}:\d{2})'
-    ]
+_SIMPLE_AMOUNT_RE = re.compile(r'^\s*(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)\s*(?:บาท|baht|thb|$)', re.IGNORECASE)
+_SIMPLE_AMOUNT_FALLBACK_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*$')
 
-    date_formats = [
-        "%d-%m-%Y %H:%M:%S", "%d/%m/%Y %H:%M:%S",
-        "%d-%m-%Y %H:%M", "%d/%m/%Y %H:%M",
-        "%d-%m-%y %H:%M:%S", "%d/%m/%y %H:%M:%S",
-        "%d/%m/%y %H:%M", "%d-%m-%y %H:%M",
-        "%d %b %Y %H:%M", "%d %b %y %H:%M",
-        "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M",
-        "%d-%m-%Y", "%d/%m/%Y",
-        "%d-%m-%y", "%d/%m/%y",
-        "%H:%M:%S", "%H:%M"
-    ]
+@functools.lru_cache(maxsize=4096)
+def _try_strptime(date_str: str, fmt: str) -> datetime | None:
+    """Memoized `datetime.strptime` that returns None instead of raising on a mismatch."""
+    try:
+        return datetime.strptime(date_str, fmt)
+    except ValueError:
+        return None
+
+def _parse_datetime(text: str) -> datetime | None:
+    """Finds the most preferred date/time shape in the text and parses it with its format."""
+    best = None
+    for match in _DATETIME_ANY_RE.finditer(text):
+        if best is None or match.lastindex < best.lastindex:
+            best = match
+            if best.lastindex == 1:
+                # Nothing can outrank the first shape; stop scanning the rest of the text.
+                break
+    if best is None:
+        return None
+
+    first = best.lastindex - 1
+    for index in range(first, len(_DATETIME_PATTERNS)):
+        if index == first:
+            date_str = best.group(best.lastindex)
+        else:
+            # The preferred candidate did not parse; fall back to the next shape.
+            match = _DATETIME_RES[index].search(text)
+            if not match:
+                continue
+            date_str = match.group(1)
 
-    return_date_time = None
-    for pattern in datetime_patterns:
-        match = re.search(pattern, processed_text_for_date, re.IGNORECASE)
+        _, sep_pos, formats = _DATETIME_PATTERNS[index]
+        fmt = formats.get(date_str[sep_pos] if sep_pos is not None else None)
+        if fmt is None:
+            # A separator this shape has no format for (e.g. 2024/05/06 12:00).
+            continue
+
+        if _DATETIME_HAS_YEAR4[index]:
+            # Thai slips often print Buddhist-era years (Gregorian + 543).
+            year_match = _YEAR4_RE.search(date_str)
+            if year_match:
+                year_in_str = int(year_match.group(0))
+                if year_in_str > 2500:
+                    date_str = date_str.replace(str(year_in_str), str(year_in_str - 543))
+
+        parsed = _try_strptime(date_str, fmt)
+        if parsed:
+            return parsed
+    return None
+
+def _is_date_or_time(candidate: str) -> bool:
+    """Checks whether a reference-number candidate is actually a date or a time of day."""
+    candidate = candidate.replace('/', '-')
+    match = _REF_DATE_RE.fullmatch(candidate)
+    if not match:
+        return False
+
+    if match.group('dmy'):
+        year4 = match.group('year4')
+        if year4:
+            year = int(year4)
+            if year > 2500:
+                candidate = candidate.replace(str(year), str(year - 543))
+            fmt = "%d-%m-%Y"
+        else:
+            fmt = "%d-%m-%y"
+    elif match.group('hms'):
+        fmt = "%H:%M:%S"
+    else:
+        fmt = "%H:%M"
+    return _try_strptime(candidate, fmt) is not None
+
+def _normalize_amount(num_str: str) -> str:
+    """Strips thousands separators from a matched amount so that float() can read it."""
+    last_sep = max(num_str.rfind('.'), num_str.rfind(','))
+    if last_sep == -1:
+        return num_str
+    head, sep, tail = num_str[:last_sep], num_str[last_sep], num_str[last_sep + 1:]
+    if len(tail) <= 2:
+        # One or two trailing digits make the last separator, '.' or ',', the decimal
+        # point: 1,234.56 -> 1234.56, 1.234,56 -> 1234.56, 12,50 -> 12.50.
+        is_decimal = True
+    else:
+        # Three digits are ambiguous. The separator groups thousands when it repeats
+        # or is a lone comma (1.234.567 -> 1234567, 1,500 -> 1500); a lone dot, or one
+        # after a different separator, stays the decimal point (1.500, 1,234.567).
+        is_decimal = sep not in head and (sep == '.' or '.' in head)
+    return head.replace(',', '').replace('.', '') + ('.' if is_decimal else '') + tail
+
+def _parse_amount(lower_text: str) -> float | None:
+    """Returns the first plausible amount, trying keyword-anchored patterns before bare numbers."""
+    # The patterns only capture digits and separators, so once the separators are
+    # normalized float() cannot fail and needs no try/except.
+    for pattern in _AMOUNT_KW_RES:
+        match = pattern.search(lower_text)
         if match:
-            date_str = match.group(1)
-            for fmt in date_formats:
-                try:
-                    if '%Y' in fmt:
-                        year_match = re.search(r'\d{4}', date_str)
-                        if year_match and len(year_match.group(0)) == 4:
-                            year_in_str = int(year_match.group(0))
-                            if year_in_str > 2500:
-                                date_str_gregorian = date_str.replace(str(year_in_str), str(year_in_str - 543))
-                                date_time = datetime.strptime(date_str_gregorian, fmt)
-                                return_date_time = date_time
-                                break
-                    
-                    date_time = datetime.strptime(date_str, fmt)
-                    return_date_time = date_time
-                    break
-                except ValueError:
-                    continue
-            if return_date_time:
-                if return_date_time.year == 1900 and return_date_time.month == 1 and return_date_time.day == 1:
-                    bangkok_tz = pytz.timezone('Asia/Bangkok')
-                    current_time_bangkok = datetime.now(bangkok_tz)
-                    return_date_time = current_time_bangkok.replace(
-                        hour=return_date_time.hour,
-                        minute=return_date_time.minute,
-                        second=return_date_time.second,
-                        microsecond=0,
-                        tzinfo=None
-                    )
-                break
-    
-    date_time = return_date_time
-
-    ref_patterns = [
-        r'(?:Ref\s*|Reference\s*|เลขที่อ้างอิง\s*|Ref No\.\s*|TRAN ID:\s*|TRN ID:\s*|Trx Ref:\s*|TRN\s*|Txn\s*|Transaction No\.\s*|หมายเลขอ้างอิง\s*|รหัสอ้างอิง\s*|รหัสรายการ\s*|หมายเลขรายการ\s*|เลขที่อ้างอิงรายการ\s*)(\S{8,40})', 
-        r'(\d{10,30})', 
-        r'(?:R\s*|TID\s*|Tran ID\s*|Ref\s*)\s*(\d{6,25})',
-        r'([A-Z0-9]{8,40})' 
-    ]
-    for pattern in ref_patterns:
-        match = re.search(pattern, lower_text, re.IGNORECASE)
+            amount = float(_normalize_amount(match.group(1)))
+            if amount > 0.99:
+                return amount
+
+    for pattern in _AMOUNT_FALLBACK_RES:
+        match = pattern.search(lower_text)
         if match:
-            reference_no = match.group(1).strip()
-            is_date_or_time = False
-            temp_dt_str = reference_no.replace('/', '-').replace(' ', ' ') 
-            for fmt in date_formats:
-                try:
-                    if '%Y' in fmt:
-                        year_in_ref_match = re.search(r'\d{4}', temp_dt_str)
-                        if year_in_ref_match and len(year_in_ref_match.group(0)) == 4:
-                            year_in_ref = int(year_in_ref_match.group(0))
-                            if year_in_ref > 2500:
-                                temp_dt_str = temp_dt_str.replace(str(year_in_ref), str(year_in_ref - 543))
-
-                    datetime.strptime(temp_dt_str, fmt)
-                    is_date_or_time = True
-                    break
-                except (ValueError, AttributeError):
-                    continue
-            
-            if not is_date_or_time:
-                is_amount = False
-                try:
-                    if parse_simple_amount(reference_no) is not None:
-                        is_amount = True
-                except:
-                    pass
-
-                if not is_amount:
-                    break
-                else:
-                    reference_no = None
-            else:
-                reference_no = None
+            amount = float(_normalize_amount(match.group(1)))
+            if amount > 0.99:
+                return amount
+    return None
 
-    return {
-        "amount": amount,
-        "date_time": date_time,
-        "reference_no": reference_no
-    }
+def _find_reference(lower_text: str) -> str | None:
+    """Returns the first reference-number candidate that is neither a date/time nor an amount."""
+    # The patterns are tried in priority order rather than fused into one leftmost
+    # alternation, otherwise the catch-all alphanumeric pattern would pick up plain
+    # words that appear before an explicit "ref" keyword.
+    for pattern in _REF_RES:
+        match = pattern.search(lower_text)
+        if match:
+            candidate = match.group(1) # The captures never contain whitespace
+            # parse_simple_amount never raises, so no exception guard is needed here.
+            if not _is_date_or_time(candidate) and parse_simple_amount(candidate) is None:
+                return candidate
+    return None
+
+class ParsedSlip(NamedTuple):
+    amount: Optional[float]
+    date_time: Optional[datetime]
+    reference_no: Optional[str]
+
+def _parse_slip_fields(text: str) -> ParsedSlip:
+    """Pure part of parse_slip_text; time-only dates are left as 1900-01-01 here."""
+    lower_text = text.lower()
+
+    # Enhanced Amount Parsing
+    amount = _parse_amount(lower_text)
+
+    # Thai month names need non-ASCII text; str.isascii() is O(1) on CPython strings,
+    # so English-only slips skip the substitution pass entirely.
+    if lower_text.isascii():
+        processed_text_for_date = lower_text
+    else:
+        processed_text_for_date = _THAI_MONTH_RE.sub(_thai_month_to_english, lower_text)
+
+    date_time = _parse_datetime(processed_text_for_date)
+
+    reference_no = _find_reference(lower_text)
+
+    return ParsedSlip(amount, date_time, reference_no)
+
+# The cache keeps its keys alive, so only OCR-sized texts are cached; longer input
+# (e.g. arbitrary text posted to /parse-slip-text) is parsed without being retained.
+PARSE_CACHE_MAX_TEXT_LENGTH = 4096
+_parse_slip_fields_cached = functools.lru_cache(maxsize=1024)(_parse_slip_fields)
+
+def parse_slip_text(text: str) -> ParsedSlip:
+    """Analyzes text from a slip to extract key information: amount, date/time, reference number."""
+    if len(text) <= PARSE_CACHE_MAX_TEXT_LENGTH:
+        parsed = _parse_slip_fields_cached(text)
+    else:
+        parsed = _parse_slip_fields(text)
+    return_date_time = parsed.date_time
+    # A time-only slip is dated today, which must not be frozen into the cache.
+    if return_date_time and return_date_time.year == 1900 and return_date_time.month == 1 and return_date_time.day == 1:
+        current_time_bangkok = datetime.now(_BANGKOK_TZ)
+        return parsed._replace(date_time=current_time_bangkok.replace(
+            hour=return_date_time.hour,
+            minute=return_date_time.minute,
+            second=return_date_time.second,
+            microsecond=0,
+            tzinfo=None
+        ))
+    return parsed
 
 def parse_simple_amount(text: str) -> float | None:
-    """Attempts to extract a number representing an amount from user-provided text."""
-    amount_match = re.search(r'^\s*(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)\s*(?:บาท|baht|thb|$)', text.strip(), re.IGNORECASE)
+    """Attempts to extract a number representing an amount from user-provided text; returns None instead of raising."""
+    stripped = text.strip()
+    amount_match = _SIMPLE_AMOUNT_RE.search(stripped)
     if amount_match:
-        try:
-            num_str = amount_match.group(1).replace(',', '')
-            if num_str.count('.') > 1:
-                parts = num_str.split('.')
-                num_str = "".join(parts[:-1]) + "." + parts[-1]
-            
-            amount = float(num_str)
-            if amount > 0:
-                return amount
-        except ValueError:
-            return None
-    
-    amount_match_fallback = re.search(r'^\s*(\d+(?:\.\d+)?)\s*$', text.strip())
+        amount = float(_normalize_amount(amount_match.group(1)))
+        if amount > 0:
+            return amount
+
+    amount_match_fallback = _SIMPLE_AMOUNT_FALLBACK_RE.search(stripped)
     if amount_match_fallback:
-        try:
-            amount = float(amount_match_fallback.group(1))
-            if amount > 0:
-                return amount
-        except ValueError:
-            return None
-            
+        amount = float(amount_match_fallback.group(1))
+        if amount > 0:
+            return amount
+
     return None
 
 class ParsedSlipResponse(BaseModel):
@@ -302,17 +635,33 @@ class ParsedSlipResponse(BaseModel):
     reference_no: Optional[str]
     raw_text: Optional[str] = None
 
+class ParsedSlipBatchItem(ParsedSlipResponse):
+    error: Optional[str] = None # Set when OCR failed for this image; the other fields are then null
+
+def _slip_payload(parsed_data: ParsedSlip, raw_text: str) -> dict:
+    """Builds the ParsedSlipResponse shape as a plain dict."""
+    return {
+        "amount": parsed_data.amount,
+        "date_time": parsed_data.date_time,
+        "reference_no": parsed_data.reference_no,
+        "raw_text": raw_text
+    }
+
+def _slip_response(parsed_data: ParsedSlip, raw_text: str) -> ORJSONResponse:
+    """Serializes parsed slip data straight to JSON in the ParsedSlipResponse shape."""
+    # parse_slip_text already produces values of the declared field types, so the
+    # Pydantic round trip is skipped. Returning a Response directly also bypasses
+    # FastAPI's response_model validation; the model is still used for the docs.
+    return ORJSONResponse(_slip_payload(parsed_data, raw_text))
+
 @app.post("/parse-slip-image", response_model=ParsedSlipResponse, summary="Perform OCR on an image and parse slip information")
 async def parse_slip_image(file: UploadFile = File(...)):
     """
     Receives a slip image file (PNG, JPG), performs OCR to extract text,
     then analyzes the text to extract amount, date/time, and reference number.
     """
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Only image files are allowed.")
+    image_bytes = await _read_image_upload(file)
 
-    image_bytes = await file.read()
-    
     try:
         raw_text = await perform_ocr(image_bytes)
     except RuntimeError as e:
@@ -322,14 +671,54 @@ async def parse_slip_image(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to perform OCR: {e}")
 
-    parsed_data = parse_slip_text(raw_text)
+    # Parsing is CPU-bound; keep it off the event loop so other requests' OCR calls keep flowing.
+    parsed_data = await asyncio.to_thread(parse_slip_text, raw_text)
+    return _slip_response(parsed_data, raw_text)
+
+def _parse_slip_texts(ocr_results: List["str | HTTPException"]) -> List[dict]:
+    """Parses a batch of OCR results into ParsedSlipBatchItem-shaped dicts."""
+    items = []
+    for result in ocr_results:
+        if isinstance(result, HTTPException):
+            items.append({"amount": None, "date_time": None, "reference_no": None, "raw_text": None, "error": result.detail})
+        else:
+            items.append({**_slip_payload(parse_slip_text(result), result), "error": None})
+    return items
+
+@app.post("/parse-slip-images", response_model=List[ParsedSlipBatchItem], summary="Perform OCR on several images at once and parse each slip")
+async def parse_slip_images(files: List[UploadFile] = File(...)):
+    """
+    Receives up to 16 slip images, runs OCR on all of them in a single Vision
+    request, and returns the parsed information for each image in upload order.
+    An image that could not be read has its `error` set instead of failing the batch.
+    """
+    if len(files) > OCR_BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Too many files. At most {OCR_BATCH_MAX_IMAGES} images can be sent at once.")
+
+    images = []
+    total_bytes = 0
+    for file in files:
+        remaining = MAX_BATCH_UPLOAD_BYTES - total_bytes
+        if remaining < MAX_UPLOAD_BYTES:
+            # The batch budget, not the per-image cap, is the binding limit for this file.
+            image_bytes = await _read_image_upload(
+                file, remaining, f"Images are too large. The maximum total size is {MAX_BATCH_UPLOAD_BYTES} bytes."
+            )
+        else:
+            image_bytes = await _read_image_upload(file)
+        images.append(image_bytes)
+        total_bytes += len(image_bytes)
+
+    try:
+        ocr_results = await perform_ocr_batch(images)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to perform OCR: {e}")
 
-    return ParsedSlipResponse(
-        amount=parsed_data["amount"],
-        date_time=parsed_data["date_time"],
-        reference_no=parsed_data["reference_no"],
-        raw_text=raw_text
-    )
+    return ORJSONResponse(await asyncio.to_thread(_parse_slip_texts, ocr_results))
 
 class ParseTextRequest(BaseModel):
     text: str
@@ -341,9 +730,4 @@ async def parse_slip_text_direct(request: ParseTextRequest):
     amount, date/time, and reference number.
     """
     parsed_data = parse_slip_text(request.text)
-    return ParsedSlipResponse(
-        amount=parsed_data["amount"],
-        date_time=parsed_data["date_time"],
-        reference_no=parsed_data["reference_no"],
-        raw_text=request.text
-    )
\ No newline at end of file
+    return _slip_response(parsed_data, request.text)
\ No newline at end of file